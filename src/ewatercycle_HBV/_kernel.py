@@ -0,0 +1,212 @@
+"""Compiled HBV kernel: runs a whole forcing series in one call instead of one BMI update per timestep."""
+import numpy as np
+
+try:
+    import numba as nb
+    prange = nb.prange
+except ModuleNotFoundError:
+    nb = None
+    prange = range
+
+
+# threshold temperature (degree C) below which precipitation falls as snow, as in HBV-bmi
+TT = -0.5
+
+
+def njit(*args, **kwargs):
+    """`numba.njit` if numba is installed, otherwise the function is left as plain (slow) python.
+
+    Install numba using: `pip install ewatercycle-HBV[numba]`
+    """
+    if nb is not None:
+        return nb.njit(*args, **kwargs)
+
+    def decorator(func):
+        return func
+
+    return decorator
+
+
+@njit(cache=True, fastmath=True)
+def time_lag_weights(Tlag):
+    """Triangular weights spreading the outflow over ceil(Tlag) days, same as used in HBV-bmi.
+
+    Args:
+        Tlag: lag time between water falling and reaching the river in days
+
+    Returns:
+        weights: np.ndarray
+            normalised weights, sum to 1
+    """
+    nmax = int(np.ceil(Tlag))
+    if nmax <= 1:
+        return np.ones(1)
+    weights = np.zeros(nmax)
+    th = Tlag / 2
+    nh = int(np.floor(th))
+    for i in range(0, nh):
+        weights[i] = (float(i + 1) - 0.5) / th
+    i = nh
+    weights[i] = ((1 + (float(i + 1) - 1) / th) * (th - np.floor(th)) / 2
+                  + (1 + (Tlag - float(i + 1)) / th) * (np.floor(th) + 1 - th) / 2)
+    for i in range(nh + 1, int(np.floor(Tlag))):
+        weights[i] = (Tlag - float(i + 1) + 0.5) / th
+    if Tlag > np.floor(Tlag):
+        weights[int(np.floor(Tlag))] = (Tlag - np.floor(Tlag)) ** 2 / (2 * th)
+    return weights / np.sum(weights)
+
+
+@njit(cache=True, fastmath=True)
+def route(Q_tot, weights):
+    """Spreads the outflow over the following days: a convolution with the time lag weights.
+
+    Equivalent to adding the weighted outflow to a memory vector every timestep.
+    """
+    return np.convolve(Q_tot, weights)[:Q_tot.shape[0]]
+
+
+@njit(cache=True, fastmath=True)
+def partition_forcing(pr, tas):
+    """Splits precipitation into rain & snowfall and gives the degrees above the threshold (TT) driving the melt.
+
+    Doesn't depend on the states or parameters, so is done for the whole series at once before the bucket loop.
+    """
+    rain = np.where(tas < TT, np.float32(0), pr)
+    snowfall = pr - rain
+    degree_days = np.maximum(tas - np.float32(TT), np.float32(0))
+    return rain, snowfall, degree_days
+
+
+@njit(cache=True, fastmath=True)
+def _hbv_single(rain, snowfall, degree_days, pev, params, init_state, out):
+    """Runs one parameter set, writes discharge into out & returns the final state.
+
+    Only the buckets are updated timestep by timestep: the forcing is partitioned before
+    (see `partition_forcing`) and the time lag is applied afterwards to the whole series at once.
+    """
+    Imax, Ce, Sumax, Beta, Pmax, Tlag, Kf, Ks, FM = (params[0], params[1], params[2], params[3], params[4],
+                                                     params[5], params[6], params[7], params[8])
+    Si, Su, Sf, Ss, Sp = init_state
+
+    for t in range(out.shape[0]):
+        Ep = pev[t]
+
+        # snow: snowfall is stored, above the threshold the snowpack melts
+        Sp = Sp + snowfall[t]
+        melt = min(Sp, FM * degree_days[t])
+        Sp = Sp - melt
+        P = rain[t] + melt
+
+        # interception
+        if P > 0:
+            Si = Si + P
+            Pe = max(Si - Imax, 0.0)
+            Si = Si - Pe
+            Ei = 0.0
+        else:
+            Pe = 0.0
+            Ei = min(Ep, Si)
+            Si = Si - Ei
+
+        # split effective precipitation between unsaturated zone & fast flow
+        if Pe > 0:
+            Cr = (Su / Sumax) ** Beta
+            Su = Su + (1 - Cr) * Pe
+            Quf = Cr * Pe
+        else:
+            Quf = 0.0
+
+        # transpiration
+        Ep = max(0.0, Ep - Ei)
+        Ea = min(Su, Ep * (Su / (Sumax * Ce)))
+        Su = Su - Ea
+
+        # percolation
+        Qus = Pmax * (Su / Sumax)
+        Su = Su - Qus
+
+        # fast & slow reservoir
+        Sf = Sf + Quf
+        Qf = max(Kf * Sf, 0.0)
+        Sf = Sf - Qf
+
+        Ss = Ss + Qus
+        Qs = max(Ks * Ss, 0.0)
+        Ss = Ss - Qs
+
+        out[t] = Qf + Qs
+
+    # HBV-bmi rounds the lag to whole days, at least 1
+    out[:] = route(out, time_lag_weights(max(1.0, np.rint(Tlag))))
+    return Si, Su, Sf, Ss, Sp
+
+
+# (Q, final state)(pr, pev, tas, params, init_state, n) of _hbv_run: compiled on import (or loaded from the cache)
+# instead of on the first call, only these (contiguous) types are accepted.
+HBV_RUN_SIGNATURE = ("Tuple((float32[::1], UniTuple(float64, 5)))"
+                     "(float32[::1], float32[::1], float32[::1], float64[::1], UniTuple(float64, 5), int64)")
+
+
+def check_forcing_length(n, pr, pev, tas):
+    """The compiled kernels don't check bounds, refuse forcing shorter than the n timesteps to run"""
+    if n > min(pr.shape[0], pev.shape[0], tas.shape[0]):
+        msg = (
+            f"Forcing is shorter than the {n} timesteps to run: pr, evspsblpot & tas have "
+            f"{pr.shape[0]}, {pev.shape[0]} & {tas.shape[0]} timesteps."
+        )
+        raise ValueError(msg)
+
+
+def hbv_run(pr, pev, tas, params, init_state, n):
+    """Runs the HBV bucket model over n daily timesteps.
+
+    Args:
+        pr: precipitation (mm/d), contiguous float32
+        pev: potential evaporation (mm/d), contiguous float32
+        tas: mean temperature (degree C), contiguous float32
+        params: [Imax, Ce, Sumax, Beta, Pmax, Tlag, Kf, Ks, FM], contiguous float64
+        init_state: (Si, Su, Sf, Ss, Sp) as floats
+        n: number of timesteps to run
+
+    Returns:
+        Q: np.ndarray
+            discharge (mm/d) at every timestep, after the time lag
+        state: tuple
+            (Si, Su, Sf, Ss, Sp) after the last timestep
+    """
+    check_forcing_length(n, pr, pev, tas)
+    return _hbv_run(pr, pev, tas, params, init_state, n)
+
+
+@njit(HBV_RUN_SIGNATURE, cache=True, fastmath=True, boundscheck=False)
+def _hbv_run(pr, pev, tas, params, init_state, n):
+    """`hbv_run` without the length check: compiled without boundscheck, so the forcing has to cover n timesteps"""
+    rain, snowfall, degree_days = partition_forcing(pr[:n], tas[:n])
+    out = np.empty(n, np.float32)
+    state = _hbv_single(rain, snowfall, degree_days, pev[:n], params, init_state, out)
+    return out, state
+
+
+def hbv_batch(pr, pev, tas, params_matrix, init_state, out):
+    """Runs the HBV bucket model for every parameter set in parallel, on the same forcing.
+
+    Args:
+        pr: precipitation (mm/d)
+        pev: potential evaporation (mm/d)
+        tas: mean temperature (degree C)
+        params_matrix: one row of [Imax, Ce, Sumax, Beta, Pmax, Tlag, Kf, Ks, FM] per run
+        init_state: (Si, Su, Sf, Ss, Sp), shared by all runs
+        out: array of shape (number of parameter sets, number of timesteps), filled with the discharge (mm/d)
+    """
+    check_forcing_length(out.shape[1], pr, pev, tas)
+    _hbv_batch(pr, pev, tas, params_matrix, init_state, out)
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def _hbv_batch(pr, pev, tas, params_matrix, init_state, out):
+    """`hbv_batch` without the length check"""
+    n = out.shape[1]
+    rain, snowfall, degree_days = partition_forcing(pr[:n], tas[:n])
+    pev = pev[:n]
+    for k in prange(params_matrix.shape[0]):
+        _hbv_single(rain, snowfall, degree_days, pev, params_matrix[k], init_state, out[k])
@@ -2,18 +2,24 @@
 # Based on https://github.com/eWaterCycle/ewatercycle-marrmot/blob/main/src/ewatercycle_marrmot/forcing.py
 
 from datetime import datetime
+from importlib.util import find_spec
 from pathlib import Path
 from typing import Optional
+import os
 import secrets
 import string
+import tempfile
 
 import pandas as pd
 import xarray as xr
 import numpy as np
+from pydantic import PrivateAttr
 
 from ewatercycle.base.forcing import DefaultForcing
 from ewatercycle.util import get_time
 
+from ewatercycle_HBV import __version__
+
 
 RENAME_CAMELS = {'total_precipitation_sum':'pr',
                  'potential_evaporation_sum':'evspsblpot',
@@ -23,6 +29,18 @@ RENAME_CAMELS = {'total_precipitation_sum':'pr',
                  }
 
 REQUIRED_PARAMS = ["pr", "evspsblpot", "tas"]
+
+TEST_TXT_COLUMNS = ["year", "month", "day", "pr", "Q", "evspsblpot"]
+TEST_TXT_DTYPES = {"year": "int32",
+                   "month": "int8",
+                   "day": "int8",
+                   "pr": "float32",
+                   "Q": "float32",
+                   "evspsblpot": "float32",
+                   }
+# txt files above this size are read in chunks
+STREAM_THRESHOLD_BYTES = 100 * 2**20
+
 class HBVForcing(DefaultForcing):
     """Class for HBV forcing data, mainly focused on using CAMELS dataset.
 
@@ -81,6 +99,9 @@ class HBVForcing(DefaultForcing):
     alpha: Optional[float] = 1.26 # varies per catchment, mostly 1.26?
     test_data_bool: bool = False # allows to use self.from_test_txt()
 
+    # parsed txt forcing, keyed on everything that influences the parsing & cropping
+    _ds_cache: dict = PrivateAttr(default_factory=dict)
+
     def camels_txt_defined(self):
         """test whether user defined forcing file, used converting text forcing file to netcdf"""
         if len(self.camels_file) > 4:
@@ -95,15 +116,21 @@ class HBVForcing(DefaultForcing):
         else:
             return False
 
-    def from_test_txt(self) -> xr.Dataset:
+    def from_test_txt(self, chunks: Optional[int] = None) -> xr.Dataset:
         """Load forcing data from a txt file into an xarray dataset.
 
         Information:
             Must contain ["year", "month", "day", "pr","Q", "evspsblpot"] in columns
 
-            Will convert date to pandas.Timestamp()
+            Can be a tab separated .txt, comma separated .csv or a .parquet file.
+            A header row in a .txt/.csv file is skipped, the columns must still be in the order above.
+
+            Will convert date to numpy.datetime64
 
-            pr (precipitation), Q (discharge), evspsblpot (potential evaportaion) - all im mm's
+            pr (precipitation), Q (discharge), evspsblpot (potential evaportaion) - all im mm's, stored as float32
+
+        Args:
+            chunks: optional number of timesteps per (dask) chunk along time, requires dask to be installed.
 
         Returns:
             ds: xr.Dataset
@@ -111,31 +138,20 @@ class HBVForcing(DefaultForcing):
         """
         if self.directory is None or self.camels_file is None:
             self.file_not_found_error()
+        ds = self._load_cached_ds("test")
+        if ds is not None:
+            return chunk_time(ds.copy(deep=True), chunks)
         fn = self.directory / self.camels_file
-        forcing = np.loadtxt(fn, delimiter="	")
-        names = ["year", "month", "day", "pr","Q", "evspsblpot"]
-        df_in = pd.DataFrame(forcing, columns=names)
-        df_in.index = df_in.apply(lambda x: pd.Timestamp(f'{int(x.year)}-{int(x.month)}-{int(x.day)}'), axis=1)
-        df_in = df_in.drop(columns=["year", "month", "day"])
-        df_in.index.name = "time"
-        # test data has no snow but let's add in synthetic temperatures to ensure there's no snow:
-        df_in['tas'] = 25
-
-        # TODO use netcdf-cf conventions
-        ds = xr.Dataset(data_vars=df_in,
-                        attrs={
-                            "title": "HBV forcing data",
-                            "history": "Created by ewatercycle_HBV.forcing.HBVForcing.to_xarray()",
-                                },
-                        )
+        ds = load_parsed_txt(fn, parse_test_txt)
         ds, ds_name = self.crop_ds(ds, "test")
         self.evspsblpot = ds_name
         self.pr = ds_name
         self.tas = ds_name
+        self._ds_cache[self._cache_key("test")] = (ds, ds_name)
 
-        return ds
+        return chunk_time(ds.copy(deep=True), chunks)
 
-    def from_camels_txt(self) -> xr.Dataset:
+    def from_camels_txt(self, chunks: Optional[int] = None) -> xr.Dataset:
         """Load forcing data from a txt file into a xarray dataset.
 
         Note:
@@ -158,7 +174,10 @@ class HBVForcing(DefaultForcing):
 
             Will convert date to pandas.Timestamp()
 
-            Then convert from pandas to a xarray.
+            Then convert from pandas to a xarray, all variables as float32.
+
+        Args:
+            chunks: optional number of timesteps per (dask) chunk along time, requires dask to be installed.
 
         Returns:
             ds: xr.Dataset
@@ -166,53 +185,11 @@ class HBVForcing(DefaultForcing):
         """
         if self.directory is None or self.camels_file is None:
             self.file_not_found_error()
+        ds = self._load_cached_ds("CAMELS")
+        if ds is not None:
+            return chunk_time(ds.copy(deep=True), chunks)
         fn = self.directory / self.camels_file
-        data = {}
-        with open(fn, 'r') as fin:
-            line_n = 0
-            for line in fin:
-                if line_n == 0:
-                    data["lat"] = float(line.strip())
-                elif line_n == 1:
-                    data["elevation(m)"] = float(line.strip())
-                elif line_n == 2:
-                    data["area basin(m^2)"] = float(line.strip())
-                elif line_n == 3:
-                    header = line.strip()
-                else:
-                    break
-                line_n += 1
-
-        headers = header.split(' ')[3:]
-        headers[0] = "YYYY MM DD HH"
-
-        # read with pandas
-        df = pd.read_csv(fn, skiprows=4, delimiter="\t", names=headers)
-        df.index = df.apply(lambda x: pd.Timestamp(x["YYYY MM DD HH"][:-3]), axis=1)
-        df = df.drop(columns="YYYY MM DD HH")
-        df.index.name = "time"
-
-        # rename
-        new_names = [item.split('(')[0] for item in list(df.columns)]
-        rename_dict = dict(zip(headers[1:], new_names))
-        df.rename(columns=rename_dict, inplace=True)
-        rename_dict2 = {'prcp': 'pr',
-                        'tmax': 'tasmax',
-                        'tmin': 'tasmin'}
-        df.rename(columns=rename_dict2, inplace=True)
-
-        # add attributes
-        attrs = {"title": "HBV forcing data",
-                 "history": "Created by ewatercycle_HBV.forcing.HBVForcing.from_camels_txt()",
-                 "units": "daylight(s), precipitation(mm/day), mean radiation(W/m2), snow water equivalen(mm), temperature max(C), temperature min(C), temperature mean(c),vapour pressure(Pa)",
-                 }
-
-        # add the data lines with catchment characteristics to the description
-        attrs.update(data)
-
-        ds = xr.Dataset(data_vars=df,
-                        attrs=attrs,
-                        )
+        ds = load_parsed_txt(fn, parse_camels_txt)
         # Potential Evaporation conversion using srad & tasmin/maxs
         ds['evspsblpot'] = calc_pet(ds['srad'],
                              ds["tasmin"].values,
@@ -221,12 +198,32 @@ class HBVForcing(DefaultForcing):
                              self.alpha,
                              ds.attrs['elevation(m)'],
                              ds.attrs['lat']
-                             )
+                             ).astype(np.float32)
         ds['tas'] = (ds["tasmin"] + ds["tasmax"]) / 2
         ds, ds_name= self.crop_ds(ds, "CAMELS")
         self.evspsblpot = ds_name
         self.pr = ds_name
         self.tas = ds_name
+        self._ds_cache[self._cache_key("CAMELS")] = (ds, ds_name)
+        return chunk_time(ds.copy(deep=True), chunks)
+
+    def _cache_key(self, name: str) -> tuple:
+        """Everything that changes the dataset produced from the txt file, including its modification time"""
+        mtime = (self.directory / self.camels_file).stat().st_mtime
+        return (name, str(self.directory), self.camels_file, mtime, self.start_time, self.end_time, self.alpha)
+
+    def _load_cached_ds(self, name: str) -> Optional[xr.Dataset]:
+        """Returns the dataset parsed earlier with the same settings, or None if it has to be (re)parsed"""
+        cached = self._ds_cache.get(self._cache_key(name))
+        if cached is None:
+            return None
+        ds, ds_name = cached
+        # the model is pointed at the cropped file, which may have been removed since
+        if not (self.directory / ds_name).exists():
+            return None
+        self.evspsblpot = ds_name
+        self.pr = ds_name
+        self.tas = ds_name
         return ds
 
     def from_external_source(self):
@@ -289,6 +286,195 @@ class HBVForcing(DefaultForcing):
     def file_not_found_error(self):
         raise ValueError("Directory, camels_file or pr & evspsblpot values is not set correctly")
 
+# written next to the txt file so it's only parsed once
+SIDECAR_ENCODING = {"zlib": True, "complevel": 1, "dtype": "float32"}
+# attribute recording the package version that wrote the sidecar, one written by another version is parsed again
+SIDECAR_VERSION_ATTR = "ewatercycle_HBV_version"
+# what reading/writing a (broken or locked) netCDF file can raise
+NETCDF_ERRORS = (OSError, RuntimeError, ValueError)
+
+def load_parsed_txt(fn: Path, parse) -> xr.Dataset:
+    """Parses the txt file once, afterwards reads the netCDF saved next to it as long as that is newer than the txt file
+    & was written by this version of the package.
+
+    The netCDF is written to a temporary file first & then moved in place, so other processes parsing the same file
+    never see it half written. If it can't be read or written the txt file is simply parsed.
+    """
+    if fn.suffix == ".parquet":
+        # already typed & fast to read, a netCDF copy gains nothing
+        return parse(fn)
+
+    sidecar = fn.parent / f"{fn.name}.nc"
+    try:
+        if sidecar.exists() and sidecar.stat().st_mtime >= fn.stat().st_mtime:
+            ds = xr.load_dataset(sidecar)
+            if ds.attrs.pop(SIDECAR_VERSION_ATTR, None) == __version__:
+                return ds
+    except NETCDF_ERRORS:
+        pass
+
+    ds = parse(fn)
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(suffix=".nc.tmp", prefix=f"{fn.name}.", dir=fn.parent)
+        os.close(fd)
+        ds.assign_attrs({SIDECAR_VERSION_ATTR: __version__}).to_netcdf(
+            tmp, encoding={var: SIDECAR_ENCODING for var in ds.data_vars})
+        os.replace(tmp, sidecar)
+    except NETCDF_ERRORS:
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+    return ds
+
+def parse_test_txt(fn: Path) -> xr.Dataset:
+    """Parses a test forcing file, see `HBVForcing.from_test_txt`"""
+    columns = read_test_table(fn)
+    time = dates_from_columns(columns["year"].to_numpy(),
+                              columns["month"].to_numpy(),
+                              columns["day"].to_numpy())
+    pr = columns["pr"].to_numpy(dtype=np.float32)
+    # test data has no snow but let's add in synthetic temperatures to ensure there's no snow:
+    tas = np.full(pr.shape, 25, dtype=np.float32)
+
+    # TODO use netcdf-cf conventions
+    ds = xr.Dataset(data_vars={"pr": ("time", pr),
+                               "Q": ("time", columns["Q"].to_numpy(dtype=np.float32)),
+                               "evspsblpot": ("time", columns["evspsblpot"].to_numpy(dtype=np.float32)),
+                               "tas": ("time", tas),
+                               },
+                    coords={"time": time},
+                    attrs={
+                        "title": "HBV forcing data",
+                        "history": "Created by ewatercycle_HBV.forcing.HBVForcing.to_xarray()",
+                            },
+                    )
+    return ds
+
+def parse_camels_txt(fn: Path) -> xr.Dataset:
+    """Parses a CAMELS forcing file, see `HBVForcing.from_camels_txt`"""
+    data = {}
+    with open(fn, 'r') as fin:
+        line_n = 0
+        for line in fin:
+            if line_n == 0:
+                data["lat"] = float(line.strip())
+            elif line_n == 1:
+                data["elevation(m)"] = float(line.strip())
+            elif line_n == 2:
+                data["area basin(m^2)"] = float(line.strip())
+            elif line_n == 3:
+                header = line.strip()
+            else:
+                break
+            line_n += 1
+
+    headers = header.split(' ')[3:]
+    headers[0] = "YYYY MM DD HH"
+
+    # read with pandas
+    df = pd.read_csv(fn, skiprows=4, delimiter="\t", names=headers)
+    df.index = pd.to_datetime(df["YYYY MM DD HH"].str[:-3], format="%Y %m %d")
+    df = df.drop(columns="YYYY MM DD HH").astype(np.float32)
+    df.index.name = "time"
+
+    # rename
+    new_names = [item.split('(')[0] for item in list(df.columns)]
+    rename_dict = dict(zip(headers[1:], new_names))
+    df.rename(columns=rename_dict, inplace=True)
+    rename_dict2 = {'prcp': 'pr',
+                    'tmax': 'tasmax',
+                    'tmin': 'tasmin'}
+    df.rename(columns=rename_dict2, inplace=True)
+
+    # add attributes
+    attrs = {"title": "HBV forcing data",
+             "history": "Created by ewatercycle_HBV.forcing.HBVForcing.from_camels_txt()",
+             "units": "daylight(s), precipitation(mm/day), mean radiation(W/m2), snow water equivalen(mm), temperature max(C), temperature min(C), temperature mean(c),vapour pressure(Pa)",
+             }
+
+    # add the data lines with catchment characteristics to the description
+    attrs.update(data)
+
+    ds = xr.Dataset(data_vars=df,
+                    attrs=attrs,
+                    )
+    return ds
+
+def read_test_table(fn: Path, chunksize: int = 100_000) -> pd.DataFrame:
+    """Reads the columns of a test forcing file, uses the pyarrow csv reader when pyarrow is installed.
+
+    Text files larger than STREAM_THRESHOLD_BYTES are read in chunks of chunksize rows instead,
+    to limit the memory needed on huge (e.g. multi-basin) files.
+    A header row in a text file is skipped, the columns must still be in the order of TEST_TXT_COLUMNS.
+    """
+    if fn.suffix == ".parquet":
+        return pd.read_parquet(fn, columns=TEST_TXT_COLUMNS).astype(TEST_TXT_DTYPES)
+
+    sep = "," if fn.suffix == ".csv" else "\t"
+    header = 0 if has_header(fn, sep) else None
+    if fn.stat().st_size > STREAM_THRESHOLD_BYTES:
+        return stream_test_table(fn, sep, chunksize, header)
+
+    engine = "pyarrow" if find_spec("pyarrow") is not None else "c"
+    return pd.read_csv(fn,
+                       sep=sep,
+                       header=header,
+                       names=TEST_TXT_COLUMNS,
+                       dtype=TEST_TXT_DTYPES,
+                       engine=engine)
+
+def has_header(fn: Path, sep: str) -> bool:
+    """The first row is a header when its first field (the year) isn't a number"""
+    with open(fn) as fin:
+        first_field = fin.readline().split(sep)[0].strip()
+    try:
+        float(first_field)
+    except ValueError:
+        return True
+    return False
+
+def stream_test_table(fn: Path, sep: str, chunksize: int, header: Optional[int] = None) -> pd.DataFrame:
+    """Reads the file chunk by chunk into preallocated typed arrays: peak memory is one chunk on top of the result"""
+    with open(fn, "rb") as fin:
+        n_rows = sum(1 for _ in fin)
+    columns = {name: np.empty(n_rows, dtype=dtype) for name, dtype in TEST_TXT_DTYPES.items()}
+
+    offset = 0
+    for chunk in pd.read_csv(fn,
+                             sep=sep,
+                             header=header,
+                             names=TEST_TXT_COLUMNS,
+                             dtype=TEST_TXT_DTYPES,
+                             chunksize=chunksize,
+                             engine="c"):
+        k = len(chunk)
+        for name in TEST_TXT_COLUMNS:
+            columns[name][offset:offset + k] = chunk[name].to_numpy()
+        offset += k
+
+    # blank lines & the header are counted but not read
+    return pd.DataFrame({name: values[:offset] for name, values in columns.items()}, copy=False)
+
+def dates_from_columns(year: np.ndarray, month: np.ndarray, day: np.ndarray) -> np.ndarray:
+    """Combines year, month & day columns into datetime64[ns] with numpy date arithmetic, no strings involved"""
+    dates = ((year.astype(np.int64) - 1970).astype("datetime64[Y]")
+             + (month.astype(np.int64) - 1).astype("timedelta64[M]"))
+    dates = dates.astype("datetime64[D]") + (day.astype(np.int64) - 1).astype("timedelta64[D]")
+
+    # the arithmetic rolls invalid dates over (e.g. 30 Feb -> 2 Mar), refuse those instead
+    month_of_date = (dates.astype("datetime64[M]") - dates.astype("datetime64[Y]")).astype(int) + 1
+    invalid = (month_of_date != month) | (day < 1)
+    if invalid.any():
+        i = int(np.argmax(invalid))
+        raise ValueError(f"Invalid date in forcing: year {year[i]}, month {month[i]}, day {day[i]}")
+    return dates.astype("datetime64[ns]")
+
+def chunk_time(ds: xr.Dataset, chunks: Optional[int]) -> xr.Dataset:
+    """Chunks the dataset along time so large forcing can be streamed with dask, returns it as is when chunks is None"""
+    if chunks is None:
+        return ds
+    return ds.chunk({"time": chunks})
+
 def calc_pet(s_rad, t_min, t_max, doy, alpha, elev, lat) -> np.ndarray:
     """Calculates Potential Evaporation using Priestly–Taylor PET estimate, callibrated with longterm P-T trends from the camels data set (alpha).
 
@@ -1,9 +1,12 @@
 """eWaterCycle wrapper for the HBV model."""
 import json
 from collections.abc import ItemsView
+from functools import cached_property
 from pathlib import Path
 from typing import Any, Type
 
+import numpy as np
+import xarray as xr
 from ewatercycle.forcing import LumpedMakkinkForcing, CaravanForcing
 
 from ewatercycle.base.model import (
@@ -14,6 +17,11 @@ from ewatercycle.base.model import (
 from ewatercycle.container import ContainerImage
 from bmipy import Bmi
 
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
 def import_bmi():
     """"Import BMI, raise useful exception if not found"""
     try:
@@ -46,6 +54,24 @@ HBV_STATES = (
     "Sp",
 )
 
+# config entry -> forcing variable
+FORCING_CONFIG_KEYS = {
+    "precipitation_file": "pr",
+    "potential_evaporation_file": "evspsblpot",
+    "mean_temperature_file": "tas",
+}
+
+def dumps_config(config: dict) -> bytes:
+    """Serialise the config to JSON, using orjson when it is installed. Both give the same layout."""
+    if orjson is not None:
+        return orjson.dumps(config, option=orjson.OPT_INDENT_2)
+    return json.dumps(config, indent=2, ensure_ascii=False).encode()
+
+def load_forcing_var(path: str, var: str) -> xr.DataArray:
+    """Load a forcing variable the same way HBV-bmi does: values are used as is, units are not converted"""
+    with xr.open_dataset(path) as ds:
+        return ds[var].load().squeeze()
+
 class HBVMethods(eWaterCycleModel):
     """
     The eWatercycle HBV model.
@@ -61,6 +87,12 @@ class HBVMethods(eWaterCycleModel):
         "parameters": "",
         "initial_storage": "",
     }
+    # same values as in the config, kept as arrays for the kernel
+    _parameters_array: np.ndarray | None = None
+    _initial_storage_array: np.ndarray | None = None
+    # parsed once when the config is written, returned by .parameters & .states
+    _parameters_dict: dict = {}
+    _states_dict: dict = {}
 
     def _make_cfg_file(self, **kwargs) -> Path:
         """Write model configuration file."""
@@ -72,44 +104,69 @@ class HBVMethods(eWaterCycleModel):
             )
             raise ValueError(msg)
 
-        if  len(list(kwargs["parameters"])) != 9:
+        # fromiter also accepts generators & rejects non-numeric values
+        parameters = np.fromiter(kwargs["parameters"], dtype=np.float64)
+        if parameters.size != 9:
             msg = (
                 "Incorrect number of parameters provided."
             )
             raise ValueError(msg)
 
-        self._config["parameters"] = list(kwargs["parameters"])
-
         if "initial_storage" in kwargs:
-            if len(list(kwargs["initial_storage"])) != 5:
+            initial_storage = np.fromiter(kwargs["initial_storage"], dtype=np.float64)
+            if initial_storage.size != 5:
                 msg = "The model needs 5 initial storage terms."
                 raise ValueError(msg)
-
-            self._config["initial_storage"] = list(kwargs["initial_storage"])
         else:
-            self._config["initial_storage"] = [0, 0, 0, 0, 0]
+            initial_storage = np.zeros(5)
 
         # HBV does not expect a JSON array, but instead a comma separated string;
-        self._config["initial_storage"] = ",".join(str(el) for el in self._config["initial_storage"])
-        self._config["parameters"] = ",".join(str(el) for el in self._config["parameters"])
+        self._config["initial_storage"] = ",".join(map(repr, initial_storage.tolist()))
+        self._config["parameters"] = ",".join(map(repr, parameters.tolist()))
+        self._parameters_array = parameters
+        self._initial_storage_array = initial_storage
+        self._parameters_dict = dict(zip(HBV_PARAMS, self._config["parameters"].split(',')))
+        self._states_dict = dict(zip(HBV_STATES, self._config["initial_storage"].split(',')))
 
-        self._config["precipitation_file"] = str(
-            self.forcing.directory / self.forcing['pr']
-        )
-        self._config["potential_evaporation_file"] = str(
-            self.forcing.directory / self.forcing['evspsblpot']
-        )
-        self._config["mean_temperature_file"] = str(
-            self.forcing.directory / self.forcing['tas']
-        )
+        self._config.update(self._forcing_paths)
 
         config_file = self._cfg_dir / "HBV_config.json"
 
-        with config_file.open(mode="w") as f:
-            f.write(json.dumps(self._config, indent=4))
+        config_file.write_bytes(dumps_config(self._config))
 
         return config_file
 
+    @cached_property
+    def _forcing_paths(self) -> dict[str, str]:
+        """Paths of the forcing files as expected in the config, only looked up once."""
+        directory = self.forcing.directory
+        return {
+            config_key: str(directory / self.forcing[forcing_key])
+            for config_key, forcing_key in FORCING_CONFIG_KEYS.items()
+        }
+
+    @cached_property
+    def _forcing_arrays(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """pr, evspsblpot & tas as contiguous float32 arrays for the kernel, together with the time.
+
+        Loaded from file on first use only, so repeated runs don't index into xarray again.
+        """
+        pr = load_forcing_var(self._forcing_paths["precipitation_file"], "pr")
+        pev = load_forcing_var(self._forcing_paths["potential_evaporation_file"], "evspsblpot")
+        tas = load_forcing_var(self._forcing_paths["mean_temperature_file"], "tas")
+        time = pr["time"].values
+        # the kernel doesn't check bounds: separately supplied files have to cover the same timesteps
+        if not pr.shape == pev.shape == tas.shape == time.shape:
+            msg = (
+                "pr, evspsblpot & tas forcing must be 1D with the same number of timesteps, got shapes "
+                f"{pr.shape}, {pev.shape} & {tas.shape}."
+            )
+            raise ValueError(msg)
+        return (np.ascontiguousarray(pr.values, dtype=np.float32),
+                np.ascontiguousarray(pev.values, dtype=np.float32),
+                np.ascontiguousarray(tas.values, dtype=np.float32),
+                time)
+
     @property
     def parameters(self) -> ItemsView[str, Any]:
         """List the (initial!) parameters for this model.
@@ -142,8 +199,7 @@ class HBVMethods(eWaterCycleModel):
             FM (mm/deg/d): Melt Factor: mm of melt per deg per day
 
         """
-        pars: dict[str, Any] = dict(zip(HBV_PARAMS, self._config["parameters"].split(',')))
-        return pars.items()
+        return self._parameters_dict.items()
 
     @property
     def states(self) -> ItemsView[str, Any]:
@@ -157,8 +213,7 @@ class HBVMethods(eWaterCycleModel):
             Sp (mm): SnowPack Storage, amount of snow stored
 
         """
-        pars: dict[str, Any] = dict(zip(HBV_STATES, self._config["initial_storage"].split(',')))
-        return pars.items()
+        return self._states_dict.items()
 
 
     def finalize(self) -> None:
@@ -180,3 +235,59 @@ class HBV(ContainerizedModel, HBVMethods):
 class HBVLocal(LocalModel, HBVMethods):
     """The HBV eWaterCycle model, with the local BMI."""
     bmi_class: Type[Bmi] = import_bmi()
+
+    def run_all(self) -> xr.DataArray:
+        """Run the whole forcing period at once with the compiled HBV kernel, bypassing the BMI.
+
+        Uses the parameters & initial storage passed to `.setup()`.
+        Much faster than calling `.update()` every timestep, but the states can't be changed along the way.
+
+        Returns:
+            Q: xr.DataArray
+                Discharge (mm/d) at every timestep of the forcing.
+        """
+        if self._parameters_array is None:
+            msg = "Call `.setup()` with the parameters before running the model."
+            raise ValueError(msg)
+
+        # the kernel compiles on import, only pay for that when it's used
+        from ewatercycle_HBV._kernel import hbv_run
+
+        pr, pev, tas, time = self._forcing_arrays
+        init_state = tuple(self._initial_storage_array.tolist())
+        Q, _ = hbv_run(pr, pev, tas, self._parameters_array, init_state, len(time))
+
+        return xr.DataArray(Q, coords={"time": time}, dims="time", name="Q",
+                            attrs={"units": "mm/d"})
+
+    def run_ensemble(self, params_matrix, initial_storage=(0, 0, 0, 0, 0)) -> xr.DataArray:
+        """Run many parameter sets over the whole forcing period in parallel, bypassing the BMI.
+
+        Useful for calibration: all runs use the forcing of this model, `.setup()` is not needed.
+
+        Args:
+            params_matrix: one row of [Imax, Ce, Sumax, Beta, Pmax, Tlag, Kf, Ks, FM] per run
+            initial_storage: [Si, Su, Sf, Ss, Sp] used for all runs
+
+        Returns:
+            Q: xr.DataArray
+                Discharge (mm/d) with dimensions (member, time), one member per row of params_matrix.
+        """
+        params_matrix = np.asarray(params_matrix, dtype=np.float64)
+        if params_matrix.ndim != 2 or params_matrix.shape[1] != 9:
+            msg = "params_matrix must have shape (number of runs, 9)."
+            raise ValueError(msg)
+        initial_storage = np.asarray(initial_storage, dtype=np.float64)
+        if initial_storage.shape != (5,):
+            msg = "The model needs 5 initial storage terms."
+            raise ValueError(msg)
+
+        from ewatercycle_HBV._kernel import hbv_batch
+
+        pr, pev, tas, time = self._forcing_arrays
+        Q = np.empty((params_matrix.shape[0], len(time)), np.float32)
+        hbv_batch(pr, pev, tas, np.ascontiguousarray(params_matrix),
+                  tuple(initial_storage.tolist()), Q)
+
+        return xr.DataArray(Q, coords={"time": time}, dims=("member", "time"), name="Q",
+                            attrs={"units": "mm/d"})
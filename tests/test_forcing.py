@@ -1,7 +1,141 @@
+from pathlib import Path
+import os
+import shutil
+
 import numpy as np
-from ewatercycle_HBV.forcing import calc_pet
+import pytest
+from ewatercycle_HBV.forcing import (SIDECAR_VERSION_ATTR, TEST_TXT_COLUMNS, HBVForcing, calc_pet,
+                                    dates_from_columns, load_parsed_txt, parse_test_txt, read_test_table,
+                                    stream_test_table)
 
 
 def test_calc_pet():
     """tests s_rad, t_min, t_max, doy, alpha, elev, lat"""
-    assert calc_pet(np.array([0]), np.array([0]), np.array([0]), np.array([0]), np.array([0]), np.array([0]), np.array([0])) == np.array([0])
\ No newline at end of file
+    assert calc_pet(np.array([0]), np.array([0]), np.array([0]), np.array([0]), np.array([0]), np.array([0]), np.array([0])) == np.array([0])
+
+
+def test_read_test_table():
+    """columns are read with their own dtype"""
+    df = read_test_table(Path(__file__).parent / "files" / "test_forcing.txt")
+    assert list(df.columns) == TEST_TXT_COLUMNS
+    assert df["month"].dtype == np.int8
+    assert df["pr"].dtype == np.float32
+
+
+def test_stream_test_table():
+    """reading in chunks gives the same as reading at once"""
+    fn = Path(__file__).parent / "files" / "test_forcing.txt"
+    streamed = stream_test_table(fn, "\t", chunksize=100)
+    assert streamed.dtypes.equals(read_test_table(fn).dtypes)
+    np.testing.assert_array_equal(streamed["pr"].to_numpy(), read_test_table(fn)["pr"].to_numpy())
+
+
+@pytest.mark.parametrize("header", [False, True])
+def test_read_test_table_csv(tmp_path, header):
+    """a .csv, with or without header row, reads the same as the .txt"""
+    expected = read_test_table(Path(__file__).parent / "files" / "test_forcing.txt")
+    fn = tmp_path / "test_forcing.csv"
+    expected.to_csv(fn, header=header, index=False)
+    df = read_test_table(fn)
+    assert df.dtypes.equals(expected.dtypes)
+    np.testing.assert_array_equal(df.to_numpy(), expected.to_numpy())
+    streamed = stream_test_table(fn, ",", chunksize=100, header=0 if header else None)
+    np.testing.assert_array_equal(streamed.to_numpy(), expected.to_numpy())
+
+
+def test_read_test_table_parquet(tmp_path):
+    """a .parquet reads the same as the .txt"""
+    expected = read_test_table(Path(__file__).parent / "files" / "test_forcing.txt")
+    fn = tmp_path / "test_forcing.parquet"
+    expected.to_parquet(fn)
+    df = read_test_table(fn)
+    assert df.dtypes.equals(expected.dtypes)
+    np.testing.assert_array_equal(df.to_numpy(), expected.to_numpy())
+
+
+def test_dates_from_columns():
+    """handles month ends & leap years"""
+    dates = dates_from_columns(np.array([1999, 2000, 2000], dtype=np.int32),
+                               np.array([12, 2, 3], dtype=np.int8),
+                               np.array([31, 29, 1], dtype=np.int8))
+    expected = np.array(["1999-12-31", "2000-02-29", "2000-03-01"], dtype="datetime64[ns]")
+    np.testing.assert_array_equal(dates, expected)
+
+
+@pytest.mark.parametrize("year, month, day", [(2001, 2, 30), (2001, 13, 1), (2001, 4, 0)])
+def test_dates_from_columns_invalid(year, month, day):
+    """invalid dates are refused instead of rolling over into the next month/year"""
+    with pytest.raises(ValueError):
+        dates_from_columns(np.array([year], dtype=np.int32),
+                           np.array([month], dtype=np.int8),
+                           np.array([day], dtype=np.int8))
+
+
+def test_load_parsed_txt_writes_sidecar(tmp_path):
+    """second load reads the netCDF written on the first load"""
+    fn = tmp_path / "test_forcing.txt"
+    shutil.copy(Path(__file__).parent / "files" / "test_forcing.txt", fn)
+    parsed = load_parsed_txt(fn, parse_test_txt)
+    assert (tmp_path / "test_forcing.txt.nc").exists()
+
+    def fail_parse(fn):
+        raise AssertionError("should have used the sidecar")
+
+    reloaded = load_parsed_txt(fn, fail_parse)
+    np.testing.assert_array_equal(parsed["pr"].values, reloaded["pr"].values)
+    assert reloaded["pr"].dtype == np.float32
+
+
+def test_load_parsed_txt_broken_sidecar(tmp_path):
+    """an unreadable sidecar falls back to parsing, which replaces it"""
+    fn = tmp_path / "test_forcing.txt"
+    shutil.copy(Path(__file__).parent / "files" / "test_forcing.txt", fn)
+    (tmp_path / "test_forcing.txt.nc").write_bytes(b"not a netcdf file")
+
+    parsed = load_parsed_txt(fn, parse_test_txt)
+    assert parsed.sizes["time"] == 1127
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["test_forcing.txt", "test_forcing.txt.nc"]
+
+    def fail_parse(fn):
+        raise AssertionError("should have used the rewritten sidecar")
+
+    assert load_parsed_txt(fn, fail_parse).sizes["time"] == 1127
+
+
+def test_load_parsed_txt_outdated_sidecar(tmp_path):
+    """a sidecar written by another version of the package is parsed again"""
+    fn = tmp_path / "test_forcing.txt"
+    shutil.copy(Path(__file__).parent / "files" / "test_forcing.txt", fn)
+    sidecar = tmp_path / "test_forcing.txt.nc"
+    parsed = load_parsed_txt(fn, parse_test_txt)
+    parsed.assign_attrs({SIDECAR_VERSION_ATTR: "0.0.1"}).to_netcdf(sidecar)
+
+    calls = []
+
+    def count_parse(fn):
+        calls.append(fn)
+        return parse_test_txt(fn)
+
+    load_parsed_txt(fn, count_parse)
+    assert len(calls) == 1
+    assert SIDECAR_VERSION_ATTR not in load_parsed_txt(fn, count_parse).attrs
+    assert len(calls) == 1
+
+
+def test_from_test_txt_cache(tmp_path):
+    """cache hits can't be modified by the caller, a removed cropped file or changed txt file is parsed again"""
+    fn = tmp_path / "test_forcing.txt"
+    shutil.copy(Path(__file__).parent / "files" / "test_forcing.txt", fn)
+    forcing = HBVForcing(directory=tmp_path, start_time="1997-08-01T00:00:00Z", end_time="2000-08-31T00:00:00Z",
+                         shape=None, camels_file=fn.name, test_data_bool=True)
+    ds = forcing.from_test_txt()
+    ds["pr"].values[0] = -999
+    assert forcing.from_test_txt()["pr"][0] == np.float32(8.888)
+
+    (tmp_path / forcing.pr).unlink()
+    forcing.from_test_txt()
+    assert (tmp_path / forcing.pr).exists()
+
+    fn.write_text(fn.read_text().replace("8.888", "9.999", 1))
+    os.utime(fn, (fn.stat().st_atime, fn.stat().st_mtime + 10))
+    assert forcing.from_test_txt()["pr"][0] == np.float32(9.999)
@@ -0,0 +1,110 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+import xarray as xr
+from HBV import HBV as HBV_bmi
+from ewatercycle_HBV._kernel import hbv_batch, hbv_run, route, time_lag_weights
+from ewatercycle_HBV.model import load_forcing_var
+
+
+def test_time_lag_weights():
+    """weights are normalised for whole and fractional lag times"""
+    for Tlag in [0.5, 1, 1.5, 2, 3.7]:
+        weights = time_lag_weights(Tlag)
+        assert len(weights) == max(int(np.ceil(Tlag)), 1)
+        assert np.isclose(weights.sum(), 1)
+
+
+def test_hbv_run_water_balance():
+    """without evaporation all precipitation ends up either as discharge or in storage"""
+    n = 100
+    pr = np.zeros(n, np.float32)
+    pr[:10] = 10
+    pev = np.zeros(n, np.float32)
+    tas = np.full(n, 10, np.float32)
+    params = np.array([2, 0.5, 100, 2, 1, 1, 0.3, 0.05, 2], dtype=np.float64)
+    Q, state = hbv_run(pr, pev, tas, params, (0.0, 0.0, 0.0, 0.0, 0.0), n)
+    assert Q.shape == (n,)
+    assert np.isclose(pr.sum(), Q.sum() + sum(state), rtol=1e-4)
+
+
+def test_hbv_batch_matches_hbv_run():
+    """each row of the batch is the same as a single run with those parameters"""
+    rng = np.random.default_rng(42)
+    n = 200
+    pr = rng.exponential(3, n).astype(np.float32)
+    pev = rng.uniform(0, 4, n).astype(np.float32)
+    tas = rng.uniform(-5, 20, n).astype(np.float32)
+    params_matrix = np.array([[2, 0.5, 100, 2, 1, 1, 0.3, 0.05, 2],
+                              [5, 0.8, 250, 1.5, 0.5, 3.5, 0.1, 0.01, 4]], dtype=np.float64)
+    init_state = (0.0, 10.0, 0.0, 5.0, 0.0)
+    out = np.empty((2, n), np.float32)
+    hbv_batch(pr, pev, tas, params_matrix, init_state, out)
+    for k in range(2):
+        Q, _ = hbv_run(pr, pev, tas, params_matrix[k], init_state, n)
+        np.testing.assert_allclose(out[k], Q, rtol=1e-6)
+
+
+def test_route_conserves_water():
+    """a single pulse is spread over ceil(Tlag) days without losing water"""
+    Q_tot = np.zeros(10, np.float32)
+    Q_tot[0] = 1
+    Q = route(Q_tot, time_lag_weights(3.5))
+    assert np.count_nonzero(Q) == 4
+    assert np.isclose(Q.sum(), 1)
+
+
+@pytest.mark.parametrize("variant", ["plain", "cold", "cf_units"])
+def test_hbv_run_matches_hbv_bmi(tmp_path, variant):
+    """the kernel, on forcing loaded like run_all does, gives the same discharge as stepping through HBV-bmi"""
+    forcing_file = Path(__file__).parent / "files" / "test_forcing.nc"
+    if variant != "plain":
+        ds = xr.load_dataset(forcing_file)
+        if variant == "cold":
+            # temperatures around zero so the snow reservoir is used too
+            ds["tas"] = ("time", 8 * np.sin(np.arange(ds.sizes["time"]) / 30))
+        else:
+            # units attributes as in eWaterCycle generated (Caravan/Makkink) forcing
+            ds["pr"].attrs["units"] = "kg m-2 s-1"
+            ds["evspsblpot"].attrs["units"] = "kg m-2 s-1"
+            ds["tas"].attrs["units"] = "K"
+        forcing_file = tmp_path / f"{variant}_forcing.nc"
+        ds.to_netcdf(forcing_file)
+
+    params = np.array([3.0, 0.6, 180.0, 1.8, 1.2, 3.2, 0.2, 0.02, 2.5])
+    init_state = (1.0, 40.0, 2.0, 30.0, 5.0)
+    config_file = tmp_path / "HBV_config.json"
+    config_file.write_text(json.dumps({
+        "precipitation_file": str(forcing_file),
+        "potential_evaporation_file": str(forcing_file),
+        "mean_temperature_file": str(forcing_file),
+        "parameters": ",".join(map(repr, params.tolist())),
+        "initial_storage": ",".join(map(repr, init_state)),
+    }))
+
+    bmi = HBV_bmi()
+    bmi.initialize(str(config_file))
+    n = bmi.end_timestep
+    Q_bmi = np.empty(n)
+    for t in range(n):
+        bmi.update()
+        Q_bmi[t] = bmi.Q
+
+    pr, pev, tas = (np.ascontiguousarray(load_forcing_var(str(forcing_file), var).values, dtype=np.float32)
+                    for var in ["pr", "evspsblpot", "tas"])
+    Q, state = hbv_run(pr, pev, tas, params, init_state, n)
+    np.testing.assert_allclose(Q, Q_bmi, rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(state, (bmi.Si, bmi.Su, bmi.Sf, bmi.Ss, bmi.Sp), rtol=1e-4, atol=1e-4)
+
+
+def test_hbv_run_forcing_too_short():
+    """n beyond the forcing is refused instead of reading out of bounds"""
+    forcing = np.ones(10, np.float32)
+    params = np.array([2, 0.5, 100, 2, 1, 1, 0.3, 0.05, 2], dtype=np.float64)
+    with pytest.raises(ValueError):
+        hbv_run(forcing, forcing[:5].copy(), forcing, params, (0.0, 0.0, 0.0, 0.0, 0.0), 10)
+    with pytest.raises(ValueError):
+        hbv_batch(forcing, forcing[:5].copy(), forcing, params[None, :], (0.0, 0.0, 0.0, 0.0, 0.0),
+                  np.empty((1, 10), np.float32))
@@ -1 +1,34 @@
-# https://github.com/eWaterCycle/ewatercycle-hype/blob/main/tests/test_forcing.py
\ No newline at end of file
+# https://github.com/eWaterCycle/ewatercycle-hype/blob/main/tests/test_forcing.py
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from ewatercycle_HBV import model
+from ewatercycle_HBV.model import dumps_config, load_forcing_var
+
+
+@pytest.mark.parametrize("var, units", [("pr", "kg m-2 s-1"), ("tas", "K"), ("evspsblpot", "mm/d")])
+def test_load_forcing_var_keeps_values(tmp_path, var, units):
+    """values are read as is whatever the units, same as HBV-bmi"""
+    fn = tmp_path / "forcing.nc"
+    time = pd.date_range("2000-01-01", periods=2)
+    values = np.array([0.5, 280.0])
+    xr.Dataset({var: ("time", values, {"units": units})}, coords={"time": time}).to_netcdf(fn)
+
+    da = load_forcing_var(str(fn), var)
+    np.testing.assert_array_equal(da.values, values)
+
+
+def test_dumps_config_same_without_orjson(monkeypatch):
+    """the config file doesn't change depending on whether orjson is installed"""
+    pytest.importorskip("orjson")
+    config = {"precipitation_file": "/data/forcing_é.nc",
+              "parameters": "8.0,0.5,600.0,3.0,2.0,5.0,0.5,0.01,3.0",
+              "initial_storage": "0.0,100.0,0.0,5.0,0.0"}
+    with_orjson = dumps_config(config)
+    monkeypatch.setattr(model, "orjson", None)
+    assert dumps_config(config) == with_orjson
+    assert json.loads(with_orjson) == config